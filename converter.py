@@ -1,13 +1,18 @@
 """
 Core video to GIF converter using FFmpeg.
-Implements two-pass palette generation for optimal quality.
+Generates an optimized palette and applies it in a single FFmpeg run.
 """
 
+import shutil
 import subprocess
-import tempfile
-import os
+import sys
 from pathlib import Path
-from utils import get_video_duration, format_size
+from utils import format_size, get_cpu_count, log, stop_requested
+
+HWACCEL_MODES = ['auto', 'none', 'vaapi', 'videotoolbox', 'cuda', 'qsv']
+
+# VideoToolbox is always present on macOS; elsewhere let FFmpeg pick a working API
+DEFAULT_HWACCEL = 'videotoolbox' if sys.platform == 'darwin' else 'auto'
 
 class VideoToGifConverter:
     """Handles video to GIF conversion using FFmpeg."""
@@ -26,152 +31,393 @@ class VideoToGifConverter:
         self.config = config
         self.verbose = config.get('verbose', False)
         
+        # Palette kept in memory between size-target attempts: (palette key, PNG bytes)
+        self._cached_palette = None
+        
+    def _log(self, message):
+        """Print a progress message tagged with the input name, safe across parallel jobs."""
+        log(f"  [{self.input_path.name}] {message}")
+    
+    def _build_decimate_filter(self):
+        """
+        Build the duplicate-frame removal filter applied after resampling.
+        
+        Timestamps are left alone, so the GIF muxer (variable frame rate) turns
+        each dropped run into a longer delay on the frame that was kept.
+        
+        Returns:
+            FFmpeg filter string, or None if decimation is disabled
+        """
+        if not self.config.get('decimate'):
+            return None
+        
+        hi = self.config.get('decimate_hi', 64 * 12)
+        lo = self.config.get('decimate_lo', 64 * 5)
+        frac = self.config.get('decimate_frac', 0.1)
+        return f"mpdecimate=hi={hi}:lo={lo}:frac={frac}"
+    
+    def _samples_palette(self):
+        """
+        Whether the palette is generated from a reduced fps/resolution stream.
+        Per-frame palettes must track every output frame, so they are never sampled.
+        """
+        if self.config.get('new_palette'):
+            return False
+        return bool(self.config.get('palette_sample_fps') or self.config.get('palette_sample_width'))
+    
     def _build_filter_string(self, palette_mode=False):
         """
-        Build FFmpeg filter string for scaling and palette generation.
+        Build the FFmpeg fps, scaling and decimation filters for one branch of the graph.
         
         Args:
-            palette_mode: If True, build filter for palette generation
+            palette_mode: If True, build filters for the palette generation branch
             
         Returns:
             FFmpeg filter string
         """
-        filters = []
-        
-        # Trimming
-        if self.config.get('start') or self.config.get('end'):
-            trim_filter = "trim="
-            if self.config.get('start'):
-                trim_filter += f"start={self.config['start']}"
-            if self.config.get('end'):
-                if self.config.get('start'):
-                    trim_filter += ":"
-                trim_filter += f"end={self.config['end']}"
-            trim_filter += ",setpts=PTS-STARTPTS"
-            filters.append(trim_filter)
-        
-        # FPS
         fps = self.config.get('fps', 15)
-        filters.append(f"fps={fps}")
-        
-        # Scaling
         width = self.config.get('width')
-        if width:
-            # Preserve aspect ratio, ensure even dimensions
-            filters.append(f"scale={width}:-2:flags=lanczos")
-        
-        if palette_mode:
-            # Palette generation
-            colors = self.config.get('colors', 256)
-            filters.append(f"palettegen=max_colors={colors}:stats_mode=diff")
-            return ",".join(filters)
-        else:
-            # Use palette for final GIF
-            # Return base filters and paletteuse separately to be combined properly
-            base_filters = ",".join(filters)
-            return f"{base_filters}[x];[x][1:v]paletteuse=dither=bayer:bayer_scale=5"
+        flags = 'lanczos'
+        
+        # A 256-color summary doesn't need every frame at full resolution
+        if palette_mode and self._samples_palette():
+            sample_fps = self.config.get('palette_sample_fps')
+            sample_width = self.config.get('palette_sample_width')
+            if sample_fps:
+                fps = min(fps, sample_fps)
+            if sample_width:
+                width = min(width, sample_width) if width else sample_width
+            flags = 'bilinear'
+        
+        # Preserve aspect ratio, ensure even dimensions
+        scale = f",scale={width}:-2:flags={flags}" if width else ""
+        
+        # Drop duplicates on the small resampled frames; the sampled palette branch doesn't need it
+        decimate = self._build_decimate_filter()
+        decimate = f",{decimate}" if decimate and not palette_mode else ""
+        
+        return f"fps={fps}{scale}{decimate}"
+    
+    def _hwaccel(self):
+        """Return the configured hardware decoding API ('none' disables it)."""
+        return self.config.get('hwaccel') or DEFAULT_HWACCEL
     
-    def _generate_palette(self, palette_path):
+    def _build_input_args(self, hwaccel=True):
         """
-        First pass: Generate optimized color palette.
+        Build FFmpeg input options for the source video.
+        
+        Trimming is done with input-side seeking so FFmpeg only decodes
+        the requested range instead of filtering out the rest.
         
         Args:
-            palette_path: Path to save the palette file
+            hwaccel: If False, force software decoding
             
         Returns:
-            True if successful, False otherwise
+            List of arguments ending with '-i <input>'
         """
-        filter_string = self._build_filter_string(palette_mode=True)
+        args = []
         
-        cmd = [
-            'ffmpeg',
-            '-y',  # Overwrite output file
-            '-i', str(self.input_path),
-            '-vf', filter_string,
-            str(palette_path)
-        ]
+        # Only decoding is accelerated; frames are downloaded for the CPU filters
+        if hwaccel and self._hwaccel() != 'none':
+            args.extend(['-hwaccel', self._hwaccel()])
         
-        if not self.verbose:
-            cmd.extend(['-loglevel', 'error'])
+        # Smaller probe window speeds up startup; exotic/VFR inputs may need the default
+        if self.config.get('fast_probe', True):
+            args.extend(['-probesize', '2000000', '-analyzeduration', '2000000'])
         
-        try:
-            if self.verbose:
-                print(f"  Generating palette...")
-                print(f"  Command: {' '.join(cmd)}")
+        start = self.config.get('start')
+        end = self.config.get('end')
+        
+        if start:
+            args.extend(['-ss', str(start)])
+        if end:
+            args.extend(['-t', str(end - (start or 0))])
+        
+        args.extend(['-i', str(self.input_path)])
+        return args
+    
+    def _can_reuse_palette(self):
+        """
+        Whether the conversion uses one global palette that can be captured and
+        reused. Per-frame palettes are tied to a single run.
+        """
+        return not self.config.get('new_palette')
+    
+    def _palette_key(self):
+        """
+        Config values that invalidate a cached palette. fps and width are left
+        out on purpose: they barely change the colors in the source.
+        """
+        return tuple(self.config.get(k) for k in ('start', 'end', 'colors', 'decimate'))
+    
+    def _build_filter_graph(self, capture_palette=False, reuse_palette=False):
+        """
+        Build the complete filter graph: the decoded stream is split so one
+        branch feeds palettegen and the other is mapped through paletteuse.
+        
+        Args:
+            capture_palette: If True, label the GIF [gif] and also expose the palette as [pal]
+            reuse_palette: If True, skip palettegen and apply the palette from input 1
             
-            subprocess.run(cmd, check=True, capture_output=not self.verbose)
-            return True
-        except subprocess.CalledProcessError as e:
-            print(f"Error generating palette: {e}")
-            return False
+        Returns:
+            FFmpeg filter_complex string
+        """
+        colors = self.config.get('colors', 256)
+        dither = self.config.get('dither', 'bayer')
+        new_palette = self.config.get('new_palette', False)
+        
+        # 'single' emits one palette per frame, which paletteuse picks up with new=1
+        stats_mode = 'single' if new_palette else 'diff'
+        paletteuse = f"paletteuse=dither={dither}"
+        if dither == 'bayer':
+            paletteuse += ":bayer_scale=5"
+        paletteuse += f":new={int(new_palette)}"
+        
+        palettegen = f"palettegen=max_colors={colors}:stats_mode={stats_mode}"
+        if reuse_palette:
+            return f"[0:v]{self._build_filter_string()}[x];[x][1:v]{paletteuse}"
+        
+        # Duplicate the palette so it can be written out alongside the GIF
+        palette_out = ",split[p][pal]" if capture_palette else "[p]"
+        gif_out = "[gif]" if capture_palette else ""
+        
+        if self._samples_palette():
+            # Branches resample separately: a cheap stream for the palette, full quality for the GIF
+            return (
+                f"split[a][b];"
+                f"[a]{self._build_filter_string(palette_mode=True)},{palettegen}{palette_out};"
+                f"[b]{self._build_filter_string()}[x];"
+                f"[x][p]{paletteuse}{gif_out}"
+            )
+        
+        return (
+            f"{self._build_filter_string()},split[a][b];"
+            f"[a]{palettegen}{palette_out};"
+            f"[b][p]{paletteuse}{gif_out}"
+        )
     
-    def _create_gif(self, palette_path):
+    def _build_command(self, hwaccel=True, capture_palette=False, reuse_palette=False):
         """
-        Second pass: Create GIF using the generated palette.
+        Build the FFmpeg command line for the conversion.
         
         Args:
-            palette_path: Path to the palette file
+            hwaccel: If False, force software decoding
+            capture_palette: If True, also write the palette as PNG to stdout
+            reuse_palette: If True, read the palette as PNG from stdin
             
         Returns:
-            True if successful, False otherwise
+            List of command arguments
         """
-        filter_string = self._build_filter_string(palette_mode=False)
+        # 0 lets FFmpeg pick; filter graph threads need an explicit count
+        threads = self.config.get('threads', 0)
+        filter_threads = str(threads or get_cpu_count())
         
         cmd = [
             'ffmpeg',
+            '-nostdin',  # Don't read keys or switch terminal modes, even with parallel jobs
+            '-threads', str(threads),
+            '-filter_complex_threads', filter_threads,
             '-y',  # Overwrite output file
-            '-i', str(self.input_path),
-            '-i', str(palette_path),
-            '-lavfi', filter_string,
-            str(self.output_path)
+            *self._build_input_args(hwaccel),
         ]
         
+        if reuse_palette:
+            cmd.extend(['-f', 'png_pipe', '-i', 'pipe:0'])
+        
+        cmd.extend(['-filter_complex', self._build_filter_graph(capture_palette, reuse_palette)])
+        
+        if capture_palette:
+            cmd.extend([
+                '-map', '[gif]', str(self.output_path),
+                '-map', '[pal]', '-f', 'image2pipe', '-c:v', 'png', 'pipe:1'
+            ])
+        else:
+            cmd.append(str(self.output_path))
+        
         if not self.verbose:
             cmd.extend(['-loglevel', 'error'])
         
-        try:
-            if self.verbose:
-                print(f"  Creating GIF...")
-                print(f"  Command: {' '.join(cmd)}")
+        return cmd
+    
+    def _run_ffmpeg(self, cmd, input_data=None, capture_stdout=False):
+        """
+        Run an FFmpeg command.
+        
+        Args:
+            cmd: Command arguments
+            input_data: Bytes to feed to FFmpeg's stdin
+            capture_stdout: If True, return what FFmpeg writes to stdout
             
-            subprocess.run(cmd, check=True, capture_output=not self.verbose)
-            return True
-        except subprocess.CalledProcessError as e:
-            print(f"Error creating GIF: {e}")
+        Returns:
+            Captured stdout as bytes, or None
+            
+        Raises:
+            subprocess.CalledProcessError: If FFmpeg fails
+        """
+        if self.verbose:
+            self._log(f"Command: {' '.join(cmd)}")
+        
+        if capture_stdout:
+            stdout = subprocess.PIPE
+        else:
+            stdout = None if self.verbose else subprocess.DEVNULL
+        
+        if input_data is None:
+            stdin_options = {'stdin': subprocess.DEVNULL}
+        else:
+            stdin_options = {'input': input_data}
+        
+        # stderr stays small with -loglevel error and is kept so failures can be reported
+        result = subprocess.run(
+            cmd,
+            **stdin_options,
+            check=True,
+            stdout=stdout,
+            stderr=None if self.verbose else subprocess.PIPE
+        )
+        return result.stdout
+    
+    def _report_error(self, error):
+        """Print a failed FFmpeg run, including its captured stderr."""
+        self._log(f"Error creating GIF: {error}")
+        if error.stderr:
+            self._log(error.stderr.decode(errors='replace').strip())
+    
+    def _should_retry_in_software(self, error):
+        """
+        Whether a failed run might succeed without hardware decoding.
+        
+        'auto' already falls back to software inside FFmpeg, so only an
+        explicitly requested API is retried. Runs killed by a signal (negative
+        return code) or interrupted (FFmpeg exits with 255) are never retried.
+        """
+        if self._hwaccel() in ('none', 'auto'):
+            return False
+        if error.returncode < 0 or error.returncode == 255:
             return False
+        return not stop_requested()
     
-    def convert(self):
+    def convert(self, reuse_palette=None, capture_palette=False):
         """
-        Perform two-pass conversion: palette generation + GIF creation.
+        Convert in a single FFmpeg run that generates and applies the palette.
         
+        Args:
+            reuse_palette: PNG palette bytes from an earlier run; skips palette generation
+            capture_palette: If True, keep the generated palette in memory for later reuse
+            
         Returns:
             True if successful, False otherwise
         """
-        # Create temporary palette file
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as palette_file:
-            palette_path = palette_file.name
+        if stop_requested():
+            return False
+        
+        if not self._can_reuse_palette():
+            reuse_palette = None
+            capture_palette = False
+        elif reuse_palette:
+            capture_palette = False
+        
+        if self.verbose:
+            if reuse_palette:
+                self._log(f"Creating GIF with cached palette...")
+            else:
+                self._log(f"Creating GIF...")
+        
+        options = {
+            'capture_palette': capture_palette,
+            'reuse_palette': reuse_palette is not None,
+        }
+        run_options = {
+            'input_data': reuse_palette,
+            'capture_stdout': capture_palette,
+        }
         
         try:
-            # Pass 1: Generate palette
-            if not self._generate_palette(palette_path):
+            palette = self._run_ffmpeg(self._build_command(**options), **run_options)
+        except subprocess.CalledProcessError as e:
+            if not self._should_retry_in_software(e):
+                self._report_error(e)
                 return False
             
-            # Pass 2: Create GIF
-            if not self._create_gif(palette_path):
+            # Hardware decoding isn't available for every codec/driver
+            if self.verbose:
+                self._log(f"Hardware decoding failed, retrying in software...")
+            try:
+                palette = self._run_ffmpeg(self._build_command(hwaccel=False, **options), **run_options)
+            except subprocess.CalledProcessError as retry_error:
+                self._report_error(retry_error)
+                return False
+        
+        if capture_palette and palette:
+            self._cached_palette = (self._palette_key(), palette)
+        
+        if self.config.get('gifsicle', True) and not stop_requested():
+            self._postprocess_gifsicle()
+        
+        return True
+    
+    def _postprocess_gifsicle(self):
+        """
+        Optimize the GIF in place with gifsicle (inter-frame transparency
+        and lossy LZW compression), if gifsicle is installed.
+        
+        Returns:
+            True if the GIF was optimized, False otherwise
+        """
+        gifsicle = shutil.which('gifsicle')
+        if not gifsicle:
+            if self.verbose:
+                self._log("gifsicle not found, skipping optimization (install it for smaller GIFs)")
+            return False
+        
+        # --lossy needs gifsicle 1.92+; fall back to a lossless pass if it's rejected
+        lossy = self.config.get('lossy', 80)
+        option_sets = [[f'--lossy={lossy}'], []] if lossy else [[]]
+        
+        if self.verbose:
+            self._log(f"Optimizing with gifsicle...")
+        
+        for i, options in enumerate(option_sets):
+            if stop_requested():
                 return False
             
-            return True
-        finally:
-            # Clean up palette file
+            cmd = [gifsicle, '-O3', *options, '-o', str(self.output_path), str(self.output_path)]
+            
             try:
-                os.unlink(palette_path)
-            except OSError:
-                pass
+                if self.verbose:
+                    self._log(f"Command: {' '.join(cmd)}")
+                
+                subprocess.run(
+                    cmd,
+                    check=True,
+                    stdin=subprocess.DEVNULL,
+                    stdout=None if self.verbose else subprocess.DEVNULL,
+                    stderr=None if self.verbose else subprocess.PIPE
+                )
+                return True
+            except subprocess.CalledProcessError as e:
+                if i + 1 < len(option_sets):
+                    if self.verbose:
+                        self._log(f"Lossy optimization failed, retrying without --lossy...")
+                    continue
+                
+                # The unoptimized GIF is still usable
+                self._log(f"Warning: gifsicle optimization failed: {e}")
+                if e.stderr:
+                    self._log(e.stderr.decode(errors='replace').strip())
+                return False
+    
+    def _get_cached_palette(self):
+        """Return the cached palette if it's still valid for the current config."""
+        if self._cached_palette and self._cached_palette[0] == self._palette_key():
+            return self._cached_palette[1]
+        return None
     
     def convert_with_size_target(self, max_size_mb):
         """
         Convert video to GIF with file size constraint.
-        Iteratively adjusts parameters if initial conversion exceeds target size.
+        If the initial conversion exceeds the target size, fps and width are
+        scaled down by a factor predicted from the measured size.
         
         Args:
             max_size_mb: Maximum file size in megabytes
@@ -183,56 +429,59 @@ class VideoToGifConverter:
         
         # Try initial conversion
         if self.verbose:
-            print(f"  Target size: {max_size_mb} MB")
-        
-        if not self.convert():
-            return False
+            self._log(f"Target size: {max_size_mb} MB")
         
-        # Check file size
-        current_size = self.output_path.stat().st_size
-        
-        if current_size <= max_size_bytes:
-            if self.verbose:
-                print(f"  ✓ Size: {format_size(current_size)} (within target)")
-            return True
-        
-        # File too large - need to reduce size
-        print(f"  Initial size {format_size(current_size)} exceeds target {max_size_mb} MB, optimizing...")
-        
-        # Strategy: reduce fps and/or width iteratively
-        original_fps = self.config.get('fps', 15)
-        original_width = self.config.get('width')
-        
-        attempts = [
-            # Try reducing FPS first
-            {'fps': max(5, int(original_fps * 0.75)), 'width': original_width},
-            {'fps': max(5, int(original_fps * 0.5)), 'width': original_width},
-            # Then reduce both FPS and width
-            {'fps': max(5, int(original_fps * 0.75)), 'width': int(original_width * 0.75) if original_width else None},
-            {'fps': max(5, int(original_fps * 0.5)), 'width': int(original_width * 0.75) if original_width else None},
-            {'fps': max(5, int(original_fps * 0.5)), 'width': int(original_width * 0.5) if original_width else None},
-        ]
-        
-        for i, adjustment in enumerate(attempts, 1):
-            if self.verbose:
-                print(f"  Attempt {i}: fps={adjustment['fps']}, width={adjustment['width']}")
-            
-            # Update config with new parameters
-            self.config.update(adjustment)
-            
-            # Convert again
-            if not self.convert():
+        try:
+            # Keep the palette so retries can skip palette generation
+            if not self.convert(capture_palette=True):
                 return False
             
-            # Check new size
+            # Check file size
             current_size = self.output_path.stat().st_size
             
             if current_size <= max_size_bytes:
-                print(f"  ✓ Optimized to {format_size(current_size)} (fps={adjustment['fps']}, width={adjustment['width']})")
+                if self.verbose:
+                    self._log(f"✓ Size: {format_size(current_size)} (within target)")
                 return True
-        
-        # Still too large after all attempts
-        print(f"  ⚠ Unable to reduce size below {max_size_mb} MB. Final size: {format_size(current_size)}")
-        print(f"  Consider using a lower quality preset or manually specifying smaller dimensions.")
-        return True  # Still return True as conversion succeeded, just not the size target
-
+            
+            # File too large - need to reduce size
+            self._log(f"Initial size {format_size(current_size)} exceeds target {max_size_mb} MB, optimizing...")
+            
+            # Strategy: GIF size scales roughly with fps * width^2, so predict the
+            # reduction needed from the measured size instead of stepping blindly
+            original_fps = self.config.get('fps', 15)
+            original_width = self.config.get('width')
+            
+            # Slightly conservative first guess, then one aggressive fallback
+            k = (max_size_bytes / current_size) ** 0.5 * 0.95
+            
+            for i, factor in enumerate([k, k * 0.7], 1):
+                adjustment = {
+                    'fps': max(5, int(original_fps * factor)),
+                    'width': int(original_width * factor ** 0.5) if original_width else None,
+                }
+                
+                if self.verbose:
+                    self._log(f"Attempt {i}: fps={adjustment['fps']}, width={adjustment['width']}")
+                
+                # Update config with new parameters
+                self.config.update(adjustment)
+                
+                # Convert again, reusing the palette from the first attempt
+                if not self.convert(reuse_palette=self._get_cached_palette()):
+                    return False
+                
+                # Check new size
+                current_size = self.output_path.stat().st_size
+                
+                if current_size <= max_size_bytes:
+                    self._log(f"✓ Optimized to {format_size(current_size)} (fps={adjustment['fps']}, width={adjustment['width']})")
+                    return True
+            
+            # Still too large after all attempts
+            self._log(f"⚠ Unable to reduce size below {max_size_mb} MB. Final size: {format_size(current_size)}")
+            self._log(f"Consider using a lower quality preset or manually specifying smaller dimensions.")
+            return True  # Still return True as conversion succeeded, just not the size target
+        finally:
+            # Palettes are only valid for this input and target run
+            self._cached_palette = None
@@ -1,31 +1,51 @@
 """
 Quality presets for video to GIF conversion.
-Each preset defines default parameters for fps, width, and color palette size.
+Each preset defines default parameters for fps, width, color palette size,
+whether duplicate frames are dropped, how the palette is applied, and the
+gifsicle lossy level.
 """
 
+DITHER_MODES = ['bayer', 'sierra2_4a', 'floyd_steinberg', 'none']
+
 PRESETS = {
     'low': {
         'fps': 10,
         'width': 480,
         'colors': 128,
+        'decimate': True,
+        'dither': 'bayer',
+        'new_palette': False,
+        'lossy': 80,
         'description': 'Small file size, lower quality'
     },
     'medium': {
         'fps': 15,
         'width': 720,
         'colors': 256,
+        'decimate': True,
+        'dither': 'bayer',
+        'new_palette': False,
+        'lossy': 80,
         'description': 'Balanced quality and file size'
     },
     'high': {
         'fps': 20,
         'width': 1080,
         'colors': 256,
+        'decimate': False,
+        'dither': 'sierra2_4a',
+        'new_palette': True,
+        'lossy': 0,
         'description': 'High quality, larger file size'
     },
     'max': {
         'fps': None,  # Auto-detect from source video
         'width': 2160,
         'colors': 256,
+        'decimate': False,
+        'dither': 'sierra2_4a',
+        'new_palette': True,
+        'lossy': 0,
         'description': 'Maximum quality, very large file size'
     }
 }
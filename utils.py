@@ -3,12 +3,37 @@ Utility functions for video2gif tool.
 Handles file validation, path operations, and helper functions.
 """
 
+import functools
+import json
 import os
+import shutil
+import stat
 import subprocess
+import threading
+from glob import iglob
 from pathlib import Path
 
 # Common video file extensions
-VIDEO_EXTENSIONS = {'.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.webm', '.m4v', '.mpeg', '.mpg'}
+VIDEO_EXTENSIONS = frozenset({'.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.webm', '.m4v', '.mpeg', '.mpg'})
+
+# Serializes output from concurrent conversions so lines don't interleave
+_print_lock = threading.Lock()
+
+def log(*args, **kwargs):
+    """Thread-safe print."""
+    with _print_lock:
+        print(*args, **kwargs)
+
+# Set when the user interrupts a batch so workers don't start new processes
+_stop_event = threading.Event()
+
+def request_stop():
+    """Ask running conversions not to start any further FFmpeg/gifsicle processes."""
+    _stop_event.set()
+
+def stop_requested():
+    """Return True once request_stop() has been called."""
+    return _stop_event.is_set()
 
 def validate_video_file(filepath):
     """
@@ -26,38 +51,87 @@ def validate_video_file(filepath):
     """
     path = Path(filepath)
     
-    if not path.exists():
+    # Single stat() call covers both the existence and regular-file checks
+    try:
+        st = path.stat()
+    except OSError:
         raise FileNotFoundError(f"File not found: {filepath}")
     
-    if not path.is_file():
+    if not stat.S_ISREG(st.st_mode):
         raise ValueError(f"Not a file: {filepath}")
     
-    if path.suffix.lower() not in VIDEO_EXTENSIONS:
-        raise ValueError(f"Unsupported file format: {path.suffix}. Supported formats: {', '.join(VIDEO_EXTENSIONS)}")
+    # Only lowercase the suffix when the common lowercase lookup misses
+    suffix = path.suffix
+    if suffix not in VIDEO_EXTENSIONS and suffix.lower() not in VIDEO_EXTENSIONS:
+        raise ValueError(f"Unsupported file format: {suffix}. Supported formats: {', '.join(sorted(VIDEO_EXTENSIONS))}")
     
     return path
 
-def get_video_duration(filepath):
+def get_video_info(filepath):
     """
-    Get the duration of a video file in seconds using ffprobe.
+    Get the duration and frame rate of a video file with a single ffprobe call.
+    Results are cached per file path and modification time.
 
     Args:
         filepath: Path to the video file
 
     Returns:
-        Duration in seconds as float, or None if unable to determine
+        Dictionary with 'duration' and 'fps' (floats, or None if unable to determine)
     """
+    path = Path(filepath)
+    try:
+        mtime_ns = path.stat().st_mtime_ns
+    except OSError:
+        return {'duration': None, 'fps': None}
+    # Copy so callers can't modify the cached result
+    return dict(_probe_video_info(str(path), mtime_ns))
+
+@functools.lru_cache(maxsize=None)
+def _probe_video_info(filepath, mtime_ns):
+    """Run ffprobe for get_video_info. mtime_ns is only part of the cache key."""
+    info = {'duration': None, 'fps': None}
     try:
         result = subprocess.run(
-            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-             '-of', 'default=noprint_wrappers=1:nokey=1', str(filepath)],
+            ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+             '-show_entries', 'stream=r_frame_rate:format=duration',
+             '-of', 'json', filepath],
             capture_output=True,
             text=True,
             check=True
         )
-        return float(result.stdout.strip())
+        data = json.loads(result.stdout)
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError):
-        return None
+        return info
+
+    try:
+        info['duration'] = float(data['format']['duration'])
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    try:
+        # Frame rate is returned as a fraction (e.g., "30000/1001" or "30/1")
+        fps_str = data['streams'][0]['r_frame_rate']
+        if '/' in fps_str:
+            num, denom = fps_str.split('/')
+            info['fps'] = float(num) / float(denom)
+        else:
+            info['fps'] = float(fps_str)
+    except (KeyError, IndexError, TypeError, ValueError, ZeroDivisionError):
+        pass
+
+    return info
+
+def get_video_duration(filepath):
+    """
+    Get the duration of a video file in seconds using ffprobe.
+
+    Args:
+        filepath: Path to the video file
+
+    Returns:
+        Duration in seconds as float, or None if unable to determine
+    """
+    return get_video_info(filepath)['duration']
 
 def get_video_fps(filepath):
     """
@@ -69,23 +143,22 @@ def get_video_fps(filepath):
     Returns:
         Frame rate as float, or None if unable to determine
     """
+    return get_video_info(filepath)['fps']
+
+def get_cpu_count():
+    """
+    Get the number of CPUs this process may run on.
+    
+    Respects CPU affinity (e.g. taskset, container cpusets) where the
+    platform supports it, falling back to the total CPU count.
+    
+    Returns:
+        Number of usable CPUs (at least 1)
+    """
     try:
-        result = subprocess.run(
-            ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
-             '-show_entries', 'stream=r_frame_rate',
-             '-of', 'default=noprint_wrappers=1:nokey=1', str(filepath)],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        # Frame rate is returned as a fraction (e.g., "30000/1001" or "30/1")
-        fps_str = result.stdout.strip()
-        if '/' in fps_str:
-            num, denom = fps_str.split('/')
-            return float(num) / float(denom)
-        return float(fps_str)
-    except (subprocess.CalledProcessError, ValueError, FileNotFoundError, ZeroDivisionError):
-        return None
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return os.cpu_count() or 1
 
 def get_output_path(input_path, output_arg, batch_mode=False):
     """
@@ -127,22 +200,52 @@ def format_size(size_bytes):
         size_bytes /= 1024.0
     return f"{size_bytes:.2f} TB"
 
+def get_cache_dir():
+    """Return the per-user cache directory for video2gif."""
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'video2gif'
+
+@functools.lru_cache(maxsize=1)
 def check_ffmpeg_installed():
     """
     Check if FFmpeg is installed and available.
     
+    A successful check is remembered with a marker file in the cache
+    directory, so later runs skip launching FFmpeg unless the binary
+    has been modified since.
+    
     Returns:
         True if FFmpeg is available, False otherwise
     """
+    ffmpeg_path = shutil.which('ffmpeg')
+    if not ffmpeg_path:
+        return False
+    
+    marker = get_cache_dir() / 'ffmpeg_ok'
     try:
-        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-        return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
+        if marker.stat().st_mtime >= os.stat(ffmpeg_path).st_mtime:
+            return True
+    except OSError:
+        pass
+    
+    try:
+        subprocess.run([ffmpeg_path, '-version'], capture_output=True, check=True)
+    except (subprocess.CalledProcessError, OSError):
         return False
+    
+    # Best effort: a read-only home just means we check again next time
+    try:
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+    except OSError:
+        pass
+    
+    return True
 
 def expand_file_patterns(patterns):
     """
     Expand file patterns (including wildcards) into list of file paths.
+    Files matched by more than one pattern are only returned once.
     
     Args:
         patterns: List of file paths or patterns
@@ -150,16 +253,21 @@ def expand_file_patterns(patterns):
     Returns:
         List of Path objects
     """
-    from glob import glob
-    
+    seen = set()
     files = []
     for pattern in patterns:
-        # Check if pattern contains wildcards
-        if '*' in pattern or '?' in pattern:
-            matched = glob(pattern)
-            files.extend([Path(f) for f in matched])
+        # Existing paths are taken literally, so names like "Title [id].mp4"
+        # aren't misread as character classes; only glob the rest
+        if not os.path.exists(pattern) and any(c in pattern for c in '*?['):
+            matched = iglob(pattern)
         else:
-            files.append(Path(pattern))
+            matched = [pattern]
+        
+        for match in matched:
+            path = Path(match)
+            key = path.resolve()
+            if key not in seen:
+                seen.add(key)
+                files.append(path)
     
     return files
-
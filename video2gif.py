@@ -2,24 +2,27 @@
 """
 video2gif - Convert video files to optimized GIF animations.
 
-A command-line tool that uses FFmpeg's two-pass palette generation
+A command-line tool that uses FFmpeg's palette generation
 for high-quality GIF conversion with smart defaults and size targeting.
 """
 
 import argparse
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
-from presets import PRESETS, get_preset, list_presets
-from converter import VideoToGifConverter
+from presets import PRESETS, DITHER_MODES, get_preset, list_presets
+from converter import DEFAULT_HWACCEL, HWACCEL_MODES, VideoToGifConverter
 from utils import (
     validate_video_file,
     get_output_path,
     check_ffmpeg_installed,
     expand_file_patterns,
     format_size,
-    get_video_duration,
-    get_video_fps
+    get_cpu_count,
+    get_video_info,
+    log,
+    request_stop
 )
 
 def create_parser():
@@ -47,6 +50,9 @@ Examples:
   # Convert multiple videos to a directory
   video2gif *.mp4 -o gifs/
 
+  # Convert a batch, four files at a time
+  video2gif *.mp4 -o gifs/ -j 4
+
   # Custom settings: 10fps, 600px wide
   video2gif input.mp4 --fps 10 --width 600
 
@@ -106,6 +112,62 @@ Examples:
         help='Number of colors in palette: 2-256 (overrides preset)'
     )
     
+    parser.add_argument(
+        '--decimate',
+        action=argparse.BooleanOptionalAction,
+        help='Drop duplicate frames, useful for screen recordings and slideshows (default: on for low/medium presets)'
+    )
+    
+    parser.add_argument(
+        '--dither',
+        choices=DITHER_MODES,
+        help='Dithering algorithm used when applying the palette (overrides preset)'
+    )
+    
+    parser.add_argument(
+        '--new-palette',
+        action=argparse.BooleanOptionalAction,
+        help='Generate a palette per frame instead of one for the whole video (default: on for high/max presets)'
+    )
+    
+    parser.add_argument(
+        '--palette-sample-fps',
+        type=int,
+        metavar='N',
+        default=2,
+        help='Frame rate used to build the palette, 0 for the output fps (default: 2)'
+    )
+    
+    parser.add_argument(
+        '--palette-sample-width',
+        type=int,
+        metavar='PX',
+        default=320,
+        help='Width used to build the palette, 0 for the output width (default: 320)'
+    )
+    
+    parser.add_argument(
+        '--hwaccel',
+        choices=HWACCEL_MODES,
+        default=DEFAULT_HWACCEL,
+        help=f'Hardware decoding API, falls back to software on failure (default: {DEFAULT_HWACCEL})'
+    )
+    
+    # Post-processing
+    parser.add_argument(
+        '--gifsicle',
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help='Optimize the output with gifsicle if it is installed (default: on)'
+    )
+    
+    parser.add_argument(
+        '--lossy',
+        type=int,
+        metavar='LEVEL',
+        help='gifsicle lossy compression level, 0 for lossless (overrides preset; default: 80 for low/medium, 0 for high/max)'
+    )
+    
     # Trimming
     parser.add_argument(
         '--start',
@@ -121,6 +183,31 @@ Examples:
         help='End time in seconds'
     )
     
+    # Batch processing
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        metavar='N',
+        default=max(1, get_cpu_count() // 2),
+        help='Number of files to convert in parallel in batch mode (default: half the CPU cores)'
+    )
+    
+    parser.add_argument(
+        '--threads',
+        type=int,
+        metavar='N',
+        default=0,
+        help='FFmpeg threads per conversion (default: 0 = all cores, split across parallel jobs)'
+    )
+    
+    parser.add_argument(
+        '--fast-probe',
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help='Limit how much of the input FFmpeg analyzes at startup (default: on). '
+             'Use --no-fast-probe if stream detection fails, e.g. for variable frame rate sources'
+    )
+    
     # Verbosity
     parser.add_argument(
         '-v', '--verbose',
@@ -141,9 +228,12 @@ def apply_smart_defaults(config, input_path):
     Returns:
         Updated configuration dictionary
     """
+    # Probe fps and duration in one ffprobe call
+    info = get_video_info(input_path)
+
     # If fps is None, auto-detect from source video
     if config.get('fps') is None:
-        source_fps = get_video_fps(input_path)
+        source_fps = info['fps']
         if source_fps:
             # Cap at 50 fps to avoid extremely large files
             config['fps'] = min(int(source_fps), 50)
@@ -152,7 +242,7 @@ def apply_smart_defaults(config, input_path):
             config['fps'] = 30
 
     # Get video duration for smart FPS adjustment
-    duration = get_video_duration(input_path)
+    duration = info['duration']
 
     if duration:
         # For very short videos (< 3s), increase FPS slightly for smoother playback
@@ -173,7 +263,7 @@ def process_video(input_path, output_path, config):
     Returns:
         True if successful, False otherwise
     """
-    print(f"Converting: {input_path.name}")
+    log(f"Converting: {input_path.name}")
     
     # Apply smart defaults
     config = apply_smart_defaults(config, input_path)
@@ -189,12 +279,25 @@ def process_video(input_path, output_path, config):
     
     if success:
         file_size = output_path.stat().st_size
-        print(f"✓ Created: {output_path} ({format_size(file_size)})")
+        log(f"✓ Created: {output_path} ({format_size(file_size)})")
         return True
     else:
-        print(f"✗ Failed: {input_path.name}")
+        log(f"✗ Failed: {input_path.name}")
         return False
 
+def process_videos(jobs, config):
+    """
+    Process videos one after another, e.g. ones that share an output path.
+    
+    Args:
+        jobs: List of (input_path, output_path) tuples
+        config: Configuration dictionary (copied for each video)
+        
+    Returns:
+        Number of videos converted successfully
+    """
+    return sum(process_video(input_path, output_path, config.copy()) for input_path, output_path in jobs)
+
 def main():
     """Main entry point."""
     parser = create_parser()
@@ -240,17 +343,71 @@ def main():
             print("Error: colors must be between 2 and 256", file=sys.stderr)
             sys.exit(1)
         config['colors'] = args.colors
+    if args.decimate is not None:
+        config['decimate'] = args.decimate
+    if args.dither:
+        config['dither'] = args.dither
+    elif args.quality == 'low' and config['colors'] <= 16:
+        # Tiny palettes look posterized anyway; dithering only adds noise and bytes
+        config['dither'] = 'none'
+    if args.new_palette is not None:
+        config['new_palette'] = args.new_palette
     if args.start is not None:
         config['start'] = args.start
     if args.end is not None:
         config['end'] = args.end
+    if args.end is not None and args.end <= (args.start or 0):
+        print("Error: end must be after start", file=sys.stderr)
+        sys.exit(1)
     if args.max_size:
         config['max_size'] = args.max_size
     
+    config['gifsicle'] = args.gifsicle
+    if args.lossy is not None:
+        config['lossy'] = args.lossy
+    config['palette_sample_fps'] = args.palette_sample_fps
+    config['palette_sample_width'] = args.palette_sample_width
+    config['fast_probe'] = args.fast_probe
+    config['hwaccel'] = args.hwaccel
     config['verbose'] = args.verbose
     
+    if args.jobs < 1:
+        print("Error: jobs must be at least 1", file=sys.stderr)
+        sys.exit(1)
+    if args.threads < 0:
+        print("Error: threads must be 0 or greater", file=sys.stderr)
+        sys.exit(1)
+    if args.lossy is not None and args.lossy < 0:
+        print("Error: lossy must be 0 or greater", file=sys.stderr)
+        sys.exit(1)
+    if args.palette_sample_fps < 0 or args.palette_sample_width < 0:
+        print("Error: palette sample fps and width must be 0 or greater", file=sys.stderr)
+        sys.exit(1)
+    
     # Process files
     batch_mode = len(validated_files) > 1
+    
+    # Group files that would write the same GIF (e.g. a/x.mp4 and b/x.mp4 with -o gifs/)
+    # so they never run concurrently against one output file
+    jobs = {}
+    for input_path in validated_files:
+        output_path = get_output_path(input_path, args.output, batch_mode)
+        jobs.setdefault(output_path.resolve(), []).append((input_path, output_path))
+    
+    for group in jobs.values():
+        if len(group) > 1:
+            names = ", ".join(str(input_path) for input_path, _ in group)
+            print(f"Warning: {names} all write to {group[0][1]}; converting them one after another", file=sys.stderr)
+    
+    # Never start more jobs than there are outputs, so small batches keep all cores busy
+    workers = min(args.jobs, len(jobs))
+    parallel = workers > 1
+    
+    config['threads'] = args.threads
+    if parallel and not args.threads:
+        # Share the cores between concurrent FFmpeg processes instead of oversubscribing
+        config['threads'] = max(1, get_cpu_count() // workers)
+    
     success_count = 0
     
     print(f"\nProcessing {len(validated_files)} file(s) with quality preset: {args.quality}")
@@ -259,12 +416,29 @@ def main():
         print(f"Target size: {args.max_size} MB")
     print()
     
-    for input_path in validated_files:
-        output_path = get_output_path(input_path, args.output, batch_mode)
-        
-        if process_video(input_path, output_path, config.copy()):
-            success_count += 1
-        print()  # Blank line between files
+    if parallel:
+        # Each conversion runs in its own FFmpeg subprocess, so threads are enough
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(process_videos, group, config)
+                for group in jobs.values()
+            ]
+            try:
+                for future in as_completed(futures):
+                    success_count += future.result()
+            except KeyboardInterrupt:
+                # Don't start queued files or new attempts; running FFmpeg processes get the SIGINT too
+                request_stop()
+                executor.shutdown(cancel_futures=True)
+                print("\nInterrupted.", file=sys.stderr)
+                sys.exit(130)
+        print()
+    else:
+        for group in jobs.values():
+            for input_path, output_path in group:
+                if process_video(input_path, output_path, config.copy()):
+                    success_count += 1
+                print()  # Blank line between files
     
     # Summary
     if batch_mode: